@@ -1,18 +1,91 @@
-import requests
+import httpx
 import os
+import copy
 import time
 import asyncio
+import functools
+import hashlib
+import heapq
+import multiprocessing
+import shutil
 import yaml
 
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
 from pydantic import BaseModel
 from pylognet.client import LoggingClient, LogLevel
 
-from fastapi import FastAPI, APIRouter, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter
+from fastapi.responses import ORJSONResponse
 
+from background_logger import BackgroundLogger
 from controller import AudioLDMController
 
 
+# libyaml's C loader when PyYAML was built with it
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_yaml(path: str, mtime: float) -> dict:
+    with open(path, "r") as f:
+        return yaml.load(f, Loader=_YamlLoader)
+
+
+def load_config(path: str) -> dict:
+    # parsed once per file version; callers get their own copy to mutate
+    return copy.deepcopy(_load_yaml(path, os.path.getmtime(path)))
+
+
+# the model only exists in the generation process, set up by _init_model
+_model: AudioLDMController | None = None
+
+
+def _init_model(
+    checkpoint_path: str,
+    config: dict,
+    output_dir: str,
+    logger_endpoint: str,
+    logging: bool,
+    max_batch: int,
+):
+    global _model
+    logger = BackgroundLogger(
+        LoggingClient(
+            "YummyAudioGenServer",
+            logger_endpoint,
+            disable=not logging,
+        )
+    )
+    _model = AudioLDMController(checkpoint_path, config, logger, max_batch=max_batch)
+    _model.set_savepath(output_dir)
+    _model.warmup()
+
+
+def _generate_batch(jobs: list[tuple[str, str]]):
+    # Runs in the generation process, so it has to stay a picklable module-level function
+    _model.generate_batch(jobs)
+
+
+def _link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+@dataclass(slots=True)
+class Task:
+    status: str
+    timestamp: float
+    result: str | None = None
+    error: str | None = None
+
+
 class UserRequest(BaseModel):
     user_id: str
     prompt: str
@@ -25,53 +98,178 @@ class App:
         debug: bool = False,
         logging: bool = False,
     ):
-        self.__app = FastAPI()
+        self.__app = FastAPI(default_response_class=ORJSONResponse)
         self.__router = APIRouter()
         config_path = config.get("config", "./config/kaggle_custom.yaml")
         checkpoint_path = config.get("checkpoint", "./data/checkpoints/trained.ckpt")
         self.__output_dir = config.get("output", "./output")
         self.__expire_time = config.get("expire", 300)
-        self.__tasks: dict[str, dict] = {}
+        # requests queued within batch_window seconds of each other are
+        # generated together, up to max_batch at a time
+        self.__max_batch = config.get("max_batch", 4)
+        self.__batch_window = config.get("batch_window", 0.05)
+        self.__tasks: dict[str, Task] = {}
+        # task ids per status, kept in sync with self.__tasks for /queue
+        self.__by_status: dict[str, set[str]] = {
+            "pending": set(),
+            "processing": set(),
+            "done": set(),
+            "error": set(),
+        }
+        # (timestamp, task id) min-heap; entries whose timestamp no longer
+        # matches the task are stale and skipped on pop
+        self.__expiry_heap: list[tuple[float, str]] = []
+        # set when a new entry becomes the heap head, so the cleanup loop
+        # re-arms its sleep for the earlier deadline
+        self.__expiry_changed = asyncio.Event()
+        # generation is GPU-bound, so requests are queued and run one at a time
+        self.__queue: asyncio.Queue[UserRequest] = asyncio.Queue()
+        # in-flight DB uploads, referenced so they aren't garbage-collected
+        self.__uploads: set[asyncio.Task] = set()
+        # blake2b(prompt) -> expiry time, least recently used first; the wav
+        # for each key is a hard link in cache_dir, so it outlives the
+        # per-user file that the upload removes
+        self.__prompt_cache: OrderedDict[str, float] = OrderedDict()
+        self.__prompt_cache_size = config.get("prompt_cache_size", 1024)
+        # consecutive generation process restarts before giving up; each one
+        # reloads the checkpoint, so a process that keeps dying isn't retried
+        # forever
+        self.__max_restarts = config.get("max_restarts", 3)
+        self.__restarts = 0
+        # (expiry time, key) min-heap for the cleanup loop; entries whose expiry
+        # no longer matches the index are stale and skipped on pop
+        self.__cache_expiry_heap: list[tuple[float, str]] = []
+        self.__cache_dir = os.path.join(self.__output_dir, "cache")
         self.__debug = debug
         self.__endpoints = config.get("endpoints", {})
         self.__control_endpoint = self.__endpoints.get(
             "control", "http://localhost:8000"
         )
         os.makedirs(self.__output_dir, exist_ok=True)
+        # entries from a previous run aren't in the index, so start clean
+        shutil.rmtree(self.__cache_dir, ignore_errors=True)
+        os.makedirs(self.__cache_dir)
+
+        # keep-alive connection pool for uploads to the control server; async
+        # so an upload doesn't tie up a thread while the next task generates
+        self.__http = httpx.AsyncClient(
+            timeout=httpx.Timeout(30, connect=3),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=16),
+        )
 
         self.__logger_endpoint = self.__endpoints.get(
             "logger", "http://logger.local:9000"
         )
 
-        self.__logger = LoggingClient(
-            "YummyAudioGenServer",
-            self.__logger_endpoint,
-            disable=not logging,
+        self.__logger = BackgroundLogger(
+            LoggingClient(
+                "YummyAudioGenServer",
+                self.__logger_endpoint,
+                disable=not logging,
+            )
         )
 
-        self.__model = AudioLDMController(
+        # the model is loaded in a separate process so inference never holds
+        # the server's GIL and a crash there doesn't take the API down
+        self.__model_args = (
             checkpoint_path,
-            yaml.load(open(config_path, "r"), Loader=yaml.FullLoader),
-            self.__logger,
+            load_config(config_path),
+            self.__output_dir,
+            self.__logger_endpoint,
+            logging,
+            self.__max_batch,
         )
-        self.__model.set_savepath(self.__output_dir)
+        self.__executor = self.__start_generator()
 
         self.__setup_routes()
 
     def __setup_routes(self):
         self.__app.add_event_handler("startup", self.startup_event)
+        self.__app.add_event_handler("shutdown", self.shutdown_event)
         self.__router.post("/generate")(self.generate_audio)
         self.__router.get("/status/{task_id}")(self.get_status)
         self.__router.get("/queue")(self.queue_status)
         self.__router.get("/ping")(self.ping)
 
-    def __generate(self, prompt: str, output_path: str):
-        self.__model.generate_audio(
-            output_path,
-            prompt=prompt,
+    def __start_generator(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_model,
+            initargs=self.__model_args,
         )
 
-    def __save_to_db(self, user_id: str, audio_path: str):
+    def __add_task(self, user_id: str):
+        self.__remove_task(user_id)
+        self.__tasks[user_id] = Task("pending", time.time())
+        self.__by_status["pending"].add(user_id)
+        self.__touch(user_id)
+
+    def __touch(self, user_id: str):
+        timestamp = time.time()
+        self.__tasks[user_id].timestamp = timestamp
+        heapq.heappush(self.__expiry_heap, (timestamp, user_id))
+        if self.__expiry_heap[0] == (timestamp, user_id):
+            self.__expiry_changed.set()
+
+    def __set_status(self, user_id: str, status: str):
+        task = self.__tasks[user_id]
+        self.__by_status[task.status].discard(user_id)
+        task.status = status
+        self.__by_status[status].add(user_id)
+
+    def __remove_task(self, user_id: str) -> Task | None:
+        task = self.__tasks.pop(user_id, None)
+        if task is not None:
+            self.__by_status[task.status].discard(user_id)
+        return task
+
+    def __cache_key(self, prompt: str) -> str:
+        return hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+
+    def __cache_path(self, key: str) -> str:
+        return os.path.join(self.__cache_dir, f"{key}.wav")
+
+    def __cache_evict(self, key: str):
+        self.__prompt_cache.pop(key, None)
+        try:
+            os.remove(self.__cache_path(key))
+        except FileNotFoundError:
+            pass
+
+    def __cache_lookup(self, prompt: str) -> str | None:
+        key = self.__cache_key(prompt)
+        expires = self.__prompt_cache.get(key)
+        if expires is None:
+            return None
+        if expires < time.time():
+            self.__cache_evict(key)
+            return None
+        self.__prompt_cache.move_to_end(key)
+        return self.__cache_path(key)
+
+    def __cache_store(self, prompt: str, audio_path: str):
+        key = self.__cache_key(prompt)
+        self.__cache_evict(key)
+        _link_or_copy(audio_path, self.__cache_path(key))
+        expires = time.time() + self.__expire_time
+        self.__prompt_cache[key] = expires
+        heapq.heappush(self.__cache_expiry_heap, (expires, key))
+        if self.__cache_expiry_heap[0] == (expires, key):
+            self.__expiry_changed.set()
+        while len(self.__prompt_cache) > self.__prompt_cache_size:
+            self.__cache_evict(next(iter(self.__prompt_cache)))
+
+    def __complete(self, user_id: str, out_path: str):
+        self.__set_status(user_id, "done")
+        self.__tasks[user_id].result = out_path
+        self.__touch(user_id)
+        # uploaded in the background so the next generation can start now
+        upload = asyncio.create_task(self.__save_to_db(user_id, out_path))
+        self.__uploads.add(upload)
+        upload.add_done_callback(self.__uploads.discard)
+
+    async def __save_to_db(self, user_id: str, audio_path: str):
         if self.__debug:
             self.__logger.log(
                 "Database server connection skipped in debug mode",
@@ -81,16 +279,20 @@ class App:
 
         try:
             with open(audio_path, "rb") as f:
-                files = {"file": (os.path.basename(audio_path), f, "audio/wav")}
-                data = {"user_id": user_id}
+                # the open handle keeps the data alive until the upload is done;
+                # unlinking now means the expiry cleanup or a new generation for
+                # the same user can't touch the file being sent
+                os.unlink(audio_path)
                 self.__logger.log(
                     f"Saving generated audio to DB for user_id: {user_id}",
                     LogLevel.INFO,
                 )
-                response = requests.post(
-                    f"{self.__control_endpoint}/save/audio", files=files, data=data
+                # httpx streams the file into the multipart body in chunks
+                response = await self.__http.post(
+                    f"{self.__control_endpoint}/save/audio",
+                    data={"user_id": user_id},
+                    files={"file": (f"{user_id}.wav", f, "audio/wav")},
                 )
-                os.remove(audio_path)
                 response.raise_for_status()
         except Exception as e:
             self.__logger.log(
@@ -98,36 +300,121 @@ class App:
                 LogLevel.ERROR,
             )
 
-    def __background_generate(self, user_id: str, prompt: str):
+    async def __background_generate(self, requests: list[UserRequest]):
+        loop = asyncio.get_running_loop()
+        # a task may have been dropped while it sat in the queue
+        requests = [r for r in requests if r.user_id in self.__tasks]
+        if not requests:
+            return
+        out_paths = {
+            r.user_id: os.path.join(self.__output_dir, f"{r.user_id}.wav")
+            for r in requests
+        }
         try:
-            self.__tasks[user_id]["status"] = "processing"
-            out_path = os.path.join(self.__output_dir, f"{user_id}.wav")
-            self.__generate(prompt, out_path)
-            self.__tasks[user_id]["status"] = "done"
-            self.__tasks[user_id]["result"] = out_path
-            self.__tasks[user_id]["timestamp"] = time.time()
-            self.__save_to_db(user_id, out_path)
+            for user_id in out_paths:
+                self.__set_status(user_id, "processing")
+            jobs = [(out_paths[r.user_id], r.prompt) for r in requests]
+            try:
+                await loop.run_in_executor(self.__executor, _generate_batch, jobs)
+            except BrokenProcessPool:
+                # the generation process died; restart it for the next task
+                if self.__restarts < self.__max_restarts:
+                    self.__restarts += 1
+                    self.__logger.log(
+                        "Generation process died, restarting "
+                        f"({self.__restarts}/{self.__max_restarts})",
+                        LogLevel.ERROR,
+                    )
+                    self.__executor = self.__start_generator()
+                else:
+                    self.__logger.log(
+                        "Generation process died too many times, not restarting",
+                        LogLevel.ERROR,
+                    )
+                raise
         except Exception as e:
-            self.__tasks[user_id]["status"] = "error"
-            self.__tasks[user_id]["error"] = str(e)
+            for user_id in out_paths:
+                if user_id in self.__tasks:
+                    self.__set_status(user_id, "error")
+                    self.__tasks[user_id].error = str(e)
+                    self.__touch(user_id)
+            return
+        self.__restarts = 0
+
+        for r in requests:
+            try:
+                self.__cache_store(r.prompt, out_paths[r.user_id])
+            except OSError:
+                pass  # caching is best-effort; the task itself succeeded
+            if r.user_id in self.__tasks:
+                self.__complete(r.user_id, out_paths[r.user_id])
+
+    async def __next_batch(self) -> list[UserRequest]:
+        loop = asyncio.get_running_loop()
+        batch = [await self.__queue.get()]
+        deadline = loop.time() + self.__batch_window
+        while len(batch) < self.__max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.__queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def __worker(self):
+        while True:
+            batch = await self.__next_batch()
+            try:
+                # a user queued twice in one batch only gets their latest prompt
+                requests = list({r.user_id: r for r in batch}.values())
+                await self.__background_generate(requests)
+            except Exception as e:
+                # this is the only consumer, so it must survive any one batch
+                self.__logger.log(f"Generation batch failed: {e}", LogLevel.ERROR)
+            finally:
+                for _ in batch:
+                    self.__queue.task_done()
 
     async def __cleanup_expired_files(self):
         while True:
-            now = time.time()
-            expired = [
-                tid
-                for tid, t in self.__tasks.items()
-                if "timestamp" in t and now - t["timestamp"] > self.__expire_time
-            ]
-            for tid in expired:
-                result_path = self.__tasks[tid].get("result")
+            deadline = time.time() - self.__expire_time
+            while self.__expiry_heap and self.__expiry_heap[0][0] < deadline:
+                timestamp, tid = heapq.heappop(self.__expiry_heap)
+                task = self.__tasks.get(tid)
+                if task is None or task.timestamp != timestamp:
+                    continue
+                if task.status in ("pending", "processing"):
+                    # still owned by the worker; it is touched again once
+                    # it finishes, which puts it back on the heap
+                    continue
+                result_path = self.__remove_task(tid).result
                 if result_path and os.path.exists(result_path):
                     try:
                         os.remove(result_path)
                     except Exception:
                         pass
-                del self.__tasks[tid]
-            await asyncio.sleep(300)  # Check every 5 minutes
+            now = time.time()
+            while self.__cache_expiry_heap and self.__cache_expiry_heap[0][0] < now:
+                expires, key = heapq.heappop(self.__cache_expiry_heap)
+                if self.__prompt_cache.get(key) == expires:
+                    self.__cache_evict(key)
+            # sleep until the earliest deadline, or until an entry is added
+            # while both heaps are empty
+            timeout = None
+            if self.__expiry_heap:
+                timeout = max(0.0, self.__expiry_heap[0][0] - deadline)
+            if self.__cache_expiry_heap:
+                cache_timeout = max(0.0, self.__cache_expiry_heap[0][0] - now)
+                timeout = (
+                    cache_timeout if timeout is None else min(timeout, cache_timeout)
+                )
+            self.__expiry_changed.clear()
+            try:
+                await asyncio.wait_for(self.__expiry_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
     def get_app(self):
         self.__app.include_router(self.__router)
@@ -135,51 +422,80 @@ class App:
 
     # on_event("startup")
     async def startup_event(self):
+        # start the generation process now so the model is loaded before
+        # the first request instead of on it; if loading fails, the error
+        # aborts startup instead of breaking every request after it
+        await asyncio.wrap_future(self.__executor.submit(int))
         asyncio.create_task(self.__cleanup_expired_files())
+        asyncio.create_task(self.__worker())
+
+    # on_event("shutdown")
+    async def shutdown_event(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+        # the wavs are already unlinked, so an upload cut off here loses the audio
+        if self.__uploads:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*self.__uploads, return_exceptions=True),
+                    timeout=30,
+                )
+            except asyncio.TimeoutError:
+                self.__logger.log(
+                    "Timed out waiting for DB uploads during shutdown",
+                    LogLevel.ERROR,
+                )
+        await self.__http.aclose()
 
     # /generate
-    async def generate_audio(
-        self,
-        request: UserRequest,
-        background_tasks: BackgroundTasks = BackgroundTasks(),
-    ) -> JSONResponse:
-        self.__tasks[request.user_id] = {"status": "pending", "timestamp": time.time()}
-        background_tasks.add_task(
-            self.__background_generate, request.user_id, request.prompt
-        )
+    async def generate_audio(self, request: UserRequest) -> ORJSONResponse:
+        self.__add_task(request.user_id)
+        cached_path = self.__cache_lookup(request.prompt)
+        if cached_path is not None:
+            # same prompt generated recently: reuse that wav instead of queueing
+            out_path = os.path.join(self.__output_dir, f"{request.user_id}.wav")
+            try:
+                try:
+                    os.remove(out_path)
+                except FileNotFoundError:
+                    pass
+                _link_or_copy(cached_path, out_path)
+            except OSError:
+                # the cached wav is gone or couldn't be linked; generate instead
+                self.__cache_evict(self.__cache_key(request.prompt))
+                self.__queue.put_nowait(request)
+            else:
+                self.__complete(request.user_id, out_path)
+        else:
+            self.__queue.put_nowait(request)
 
         self.__logger.log(
             f"Accepted audio generation task for user_id: {request.user_id}",
             LogLevel.INFO,
         )
 
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=202,
             content={"message": "Task accepted", "task_id": request.user_id},
         )
 
     # /status/{task_id}
-    async def get_status(self, user_id: str) -> JSONResponse:
+    async def get_status(self, user_id: str) -> ORJSONResponse:
         if user_id not in self.__tasks:
-            return JSONResponse(status_code=404, content={"error": "Task not found"})
-        return JSONResponse(
-            content={"task_id": user_id, "status": self.__tasks[user_id]["status"]}
+            return ORJSONResponse(status_code=404, content={"error": "Task not found"})
+        return ORJSONResponse(
+            content={"task_id": user_id, "status": self.__tasks[user_id].status}
         )
 
     # /queue
     async def queue_status(self):
         return {
             "total": len(self.__tasks),
-            "pending": [
-                tid for tid, t in self.__tasks.items() if t["status"] == "pending"
-            ],
-            "processing": [
-                tid for tid, t in self.__tasks.items() if t["status"] == "processing"
-            ],
-            "done": [tid for tid, t in self.__tasks.items() if t["status"] == "done"],
-            "error": [tid for tid, t in self.__tasks.items() if t["status"] == "error"],
+            "pending": list(self.__by_status["pending"]),
+            "processing": list(self.__by_status["processing"]),
+            "done": list(self.__by_status["done"]),
+            "error": list(self.__by_status["error"]),
         }
 
     # /ping
-    async def ping(self) -> JSONResponse:
-        return JSONResponse(content={"message": "pong"})
+    async def ping(self) -> ORJSONResponse:
+        return ORJSONResponse(content={"message": "pong"})
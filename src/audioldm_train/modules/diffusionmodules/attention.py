@@ -2,8 +2,8 @@ from inspect import isfunction
 import math
 import torch
 import torch.nn.functional as F
-from torch import nn, einsum
-from einops import rearrange, repeat
+from torch import nn
+from einops import rearrange
 
 from audioldm_train.utilities.diffusion_util import checkpoint
 
@@ -349,21 +349,22 @@ class CrossAttention(nn.Module):
         k = self.to_k(context)
         v = self.to_v(context)
 
-        q, k, v = map(lambda t: rearrange(t, "b n (h d) -> (b h) n d", h=h), (q, k, v))
-
-        sim = einsum("b i d, b j d -> b i j", q, k) * self.scale
+        q, k, v = map(lambda t: rearrange(t, "b n (h d) -> b h n d", h=h), (q, k, v))
 
+        attn_mask = None
         if exists(mask):
-            mask = rearrange(mask, "b ... -> b (...)")
-            max_neg_value = -torch.finfo(sim.dtype).max
-            mask = repeat(mask, "b j -> (b h) () j", h=h)
-            sim.masked_fill_(~(mask == 1), max_neg_value)
-
-        # attention, what we cannot get enough of
-        attn = sim.softmax(dim=-1)
-
-        out = einsum("b i j, b j d -> b i d", attn, v)
-        out = rearrange(out, "(b h) n d -> b n (h d)", h=h)
+            # additive rather than boolean so a fully masked row still gets
+            # uniform weights instead of NaNs, as with the old masked_fill
+            mask = rearrange(mask, "b ... -> b () () (...)")
+            attn_mask = torch.zeros(mask.shape, dtype=q.dtype, device=q.device)
+            attn_mask.masked_fill_(~(mask == 1), -torch.finfo(q.dtype).max)
+
+        # attention, what we cannot get enough of; the fused kernel (flash /
+        # memory-efficient) never materializes the full i x j score matrix
+        out = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask, scale=self.scale
+        )
+        out = rearrange(out, "b h n d -> b n (h d)")
         return self.to_out(out)
 
 
@@ -1196,7 +1196,9 @@ class LatentDiffusion(DDPM):
     ):
         x = super().get_input(batch, k)
 
-        x = x.to(self.device)
+        # async when the loader pins memory; ordering on the current stream
+        # keeps it safe either way
+        x = x.to(self.device, non_blocking=True)
 
         if return_first_stage_encode:
             encoder_posterior = self.encode_first_stage(x)
@@ -1235,7 +1237,7 @@ class LatentDiffusion(DDPM):
                 if cond_stage_key != "all":
                     xc = super().get_input(batch, cond_stage_key)
                     if type(xc) == torch.Tensor:
-                        xc = xc.to(self.device)
+                        xc = xc.to(self.device, non_blocking=True)
                 else:
                     xc = batch
 
@@ -69,13 +69,13 @@ def build_dataset_json_from_list(list_path):
 
 def load_json(fname):
     print(fname)
-    with open(fname, "r") as f:
+    with open(fname, "r", encoding="utf-8") as f:
         data = json.load(f)
         return data
 
 
 def read_json(dataset_json_file):
-    with open(dataset_json_file, "r") as fp:
+    with open(dataset_json_file, "r", encoding="utf-8") as fp:
         data_json = json.load(fp)
     return data_json["data"]
 
@@ -0,0 +1,28 @@
+import queue
+import threading
+
+from pylognet.client import LoggingClient, LogLevel
+
+
+# Hands records to a daemon thread that forwards them to a LoggingClient, so
+# callers (including coroutines on the event loop) never wait on the logging server
+class BackgroundLogger:
+    def __init__(self, client: LoggingClient):
+        self.__client = client
+        self.__queue: queue.SimpleQueue[tuple[str, LogLevel]] = queue.SimpleQueue()
+        self.__thread = threading.Thread(
+            target=self.__drain, name="log-sender", daemon=True
+        )
+        self.__thread.start()
+
+    def log(self, message: str, level: LogLevel):
+        self.__queue.put((message, level))
+
+    def __drain(self):
+        while True:
+            message, level = self.__queue.get()
+            try:
+                self.__client.log(message, level)
+            except Exception:
+                # a logging server outage must not kill the sender thread
+                pass
@@ -1,8 +1,10 @@
-import shutil
+import pickle
 import os
 import torch
 
-from pylognet.client import LoggingClient, LogLevel
+from concurrent.futures import ThreadPoolExecutor
+
+from pylognet.client import LogLevel
 
 from audioldm_train.utilities.data.dataset import AudioDataset
 from audioldm_train.utilities.model_util import instantiate_from_config
@@ -10,19 +12,24 @@ from audioldm_train.utilities.model_util import instantiate_from_config
 from torch.utils.data import DataLoader
 from pytorch_lightning import seed_everything
 
+from background_logger import BackgroundLogger
+
 
 class AudioLDMController:
     def __init__(
         self,
         checkpoint_path: str,
         config: dict,
-        logger: LoggingClient,
+        logger: BackgroundLogger,
         target_arch: str = "cuda",
+        max_batch: int = 1,
     ):
         self.__config = config
         self.__logger = logger
         self.__addons = []
         self.__save_path = ""
+        self.__max_batch = max_batch
+        self.__compiled = False
 
         if "seed" in self.__config.keys():
             seed_everything(self.__config["seed"])
@@ -32,6 +39,10 @@ class AudioLDMController:
         if "precision" in self.__config.keys():
             torch.set_float32_matmul_precision(self.__config["precision"])
 
+        inference_dtype = torch.float32
+        if "inference_dtype" in self.__config.keys():
+            inference_dtype = getattr(torch, self.__config["inference_dtype"])
+
         if "dataloader_add_ons" in self.__config["data"].keys():
             self.__addons = self.__config["data"]["dataloader_add_ons"]
 
@@ -67,13 +78,24 @@ class AudioLDMController:
             raise ValueError(
                 f"Cannot find checkpoint at {checkpoint_path}, and reload_from_ckpt is None."
             )
-        checkpoint = torch.load(resume_from_checkpoint)
-
-        self.__model = instantiate_from_config(self.__config["model"])
+        # the checkpoint read doesn't depend on the model graph, so it runs
+        # while the model is being built
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            checkpoint_future = executor.submit(
+                self.__load_checkpoint, resume_from_checkpoint
+            )
+            self.__model = instantiate_from_config(self.__config["model"])
+            checkpoint = checkpoint_future.result()
         if self.__model is None:
             raise ValueError("Model is None after instantiation.")
 
-        self.__model.load_state_dict(checkpoint["state_dict"])
+        # assign=True takes the checkpoint tensors as-is instead of copying them
+        # into the freshly initialized parameters. That includes their dtype, so
+        # cast back to fp32 (a no-op for an fp32 checkpoint) to keep a half
+        # precision checkpoint from changing the dtype of every submodule
+        self.__model.load_state_dict(checkpoint["state_dict"], assign=True)
+        del checkpoint
+        self.__model.float()
         self.__model.eval()
 
         if target_arch == "cuda":
@@ -81,6 +103,64 @@ class AudioLDMController:
         else:
             self.__model.cpu()
 
+        if inference_dtype != torch.float32:
+            # only the diffusion UNet runs in reduced precision, it dominates both
+            # time and memory; the VAE, vocoder and CLAP stay fp32 so their outputs
+            # can still go through numpy
+            unet = self.__model.model.to(inference_dtype)
+            unet.forward = torch.autocast(target_arch, dtype=inference_dtype)(
+                unet.forward
+            )
+
+        if "compile_mode" in self.__config.keys() and target_arch == "cuda":
+            # shapes only vary with the batch size, so the UNet compiles once per
+            # size and reduce-overhead replays it as CUDA graphs per DDIM step.
+            # Module.compile keeps parameter names intact for the EMA swap
+            self.__model.model.diffusion_model.compile(
+                mode=self.__config["compile_mode"], fullgraph=False
+            )
+            self.__compiled = True
+
+        # built once and reused: generate_batch only swaps the data list, and
+        # the loader (no workers) re-reads it on every iteration; with at most
+        # max_batch items that is always a single batch
+        self.__dataset = AudioDataset(
+            self.__config,
+            split="test",
+            add_ons=self.__addons,
+            dataset_json={"data": []},
+        )
+        self.__loader = DataLoader(
+            self.__dataset,
+            batch_size=max_batch,
+            pin_memory=target_arch == "cuda",
+        )
+
+    def __load_checkpoint(self, path: str) -> dict:
+        if hasattr(os, "posix_fadvise"):
+            # start kernel readahead of the whole file right away
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+        # mmap'd so tensors are paged in from the file as they're copied to the
+        # device instead of being read into RAM up front
+        try:
+            return self.__torch_load(path, mmap=True)
+        except RuntimeError:
+            # legacy (non-zipfile) checkpoints can't be memory-mapped
+            return self.__torch_load(path, mmap=False)
+
+    @staticmethod
+    def __torch_load(path: str, mmap: bool) -> dict:
+        try:
+            return torch.load(path, map_location="cpu", mmap=mmap, weights_only=True)
+        except pickle.UnpicklingError:
+            # Lightning checkpoints can carry pickled objects besides the weights
+            return torch.load(path, map_location="cpu", mmap=mmap, weights_only=False)
+
     def set_savepath(self, path: str):
         if self.__model is None:
             return
@@ -88,36 +168,38 @@ class AudioLDMController:
         self.__save_path = path
         self.__model.set_log_dir(path, "", "")
 
+    def warmup(self):
+        # a throwaway generation so CUDA/cuDNN setup isn't paid by a request;
+        # a compiled UNet also needs one per batch size, so the compile + CUDA
+        # graph capture for each shape happens here too
+        sizes = range(1, self.__max_batch + 1) if self.__compiled else [1]
+        for size in sizes:
+            uuids = [f"warmup_{i}" for i in range(size)]
+            self.generate_batch([(uuid, "food") for uuid in uuids])
+            for uuid in uuids:
+                os.remove(f"{self.__save_path}/{uuid}.wav")
+
     def generate_audio(self, uuid: str, prompt: str):
+        self.generate_batch([(uuid, prompt)])
+
+    def generate_batch(self, requests: list[tuple[str, str]]):
+        # (uuid, prompt) pairs generated in one pass; each result is written to
+        # the save path as <basename of uuid>.wav
         if self.__model is None:
             raise ValueError("Model is None, cannot generate audio.")
 
-        dataset = AudioDataset(
-            self.__config,
-            split="test",
-            add_ons=self.__addons,
-            dataset_json={
-                "data": [
-                    {
-                        "wav": f"{uuid}.wav",
-                        "caption": f"Sound of eating {prompt}",
-                    }
-                ]
-            },
-        )
-        loader = DataLoader(
-            dataset,
-            batch_size=1,
-        )
-
-        self.__model.generate_sample(
-            loader,
-            unconditional_guidance_scale=self.__gscale,
-            ddim_steps=self.__ddim_steps,
-            n_gen=self.__nc_per_sample,
-        )
+        self.__dataset.data = [
+            {"wav": f"{uuid}.wav", "caption": f"Sound of eating {prompt}"}
+            for uuid, prompt in requests
+        ]
 
-        for dir in os.listdir(self.__save_path):
-            for file in os.listdir(f"{self.__save_path}/{dir}"):
-                shutil.move(f"{self.__save_path}/{dir}/{file}", f"{self.__save_path}")
-                shutil.rmtree(f"{self.__save_path}/{dir}")
+        with torch.inference_mode():
+            self.__model.generate_sample(
+                self.__loader,
+                unconditional_guidance_scale=self.__gscale,
+                ddim_steps=self.__ddim_steps,
+                n_gen=self.__nc_per_sample,
+                # an empty folder name makes the model write <uuid>.wav straight
+                # into the save path instead of a per-run subdirectory
+                name="",
+            )
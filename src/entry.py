@@ -1,6 +1,7 @@
 import argparse
 import json
 import uvicorn
+from fastapi import FastAPI
 from app import App
 
 
@@ -33,20 +34,32 @@ parser.add_argument(
     default=None,
     help="Enable logging",
 )
-args = parser.parse_args()
 
-with open(args.config, "r") as f:
-    config = json.load(f)
 
-if args.port is None:
-    args.port = config.get("system", {}).get("port", 8001)
+def create_app(config: dict, debug: bool, logging: bool) -> FastAPI:
+    return App(config, debug, logging).get_app()
 
-if args.debug is None:
-    args.debug = config.get("system", {}).get("debug_mode", False)
 
-if args.logging is None:
-    args.logging = config.get("system", {}).get("enable_logging", False)
+def main():
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = json.load(f)
+
+    if args.port is None:
+        args.port = config.get("system", {}).get("port", 8001)
+
+    if args.debug is None:
+        args.debug = config.get("system", {}).get("debug_mode", False)
+
+    if args.logging is None:
+        args.logging = config.get("system", {}).get("enable_logging", False)
+
+    # one server process owns the single model process; concurrency comes from
+    # asyncio, and scaling out means one of these per GPU behind a load balancer
+    app = create_app(config, args.debug, args.logging)
+    uvicorn.run(app, host="0.0.0.0", port=args.port, workers=1)
+
 
-app = App(config, args.debug, args.logging).get_app()
 if __name__ == "__main__":
-    uvicorn.run("entry:app", host="0.0.0.0", port=args.port)
+    main()
@@ -17,18 +17,23 @@ prepare_eatingsound_for_audioldm_local.py
 
 import random
 import argparse
+import csv
+import functools
 import logging
+import math
+import os
+import shutil
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Iterable, Optional
 
 import soundfile as sf
-import torchaudio
-import torchaudio.transforms as T
-import pandas as pd
+import soxr
 import numpy as np
-import json
+import orjson
+from numba import njit
 from tqdm import tqdm
 
 # -----------------------
@@ -49,7 +54,7 @@ random.seed(0)
 @dataclass
 class AudioMeta:
     src_path: Path
-    out_path: Path
+    out_path: str
     duration: float
     label: Optional[str]
     caption: str
@@ -57,42 +62,161 @@ class AudioMeta:
 
 def discover_audio_files(
     root: Path, exts: tuple[str, ...] = (".wav", ".mp3", ".flac", ".m4a", ".ogg")
-) -> Iterable[Path]:
-    for p in root.rglob("*"):
-        if p.is_file() and p.suffix.lower() in exts:
-            yield p
-
-
-def normalize_audio(wave: np.ndarray) -> np.ndarray:
-    peak = np.max(np.abs(wave))
-    if peak < 1e-8:
-        return wave
-    return wave / peak
-
-
-def preprocess_and_save(src: Path, dst: Path, sample_rate: int) -> tuple[float, int]:
-    waveform, sr = torchaudio.load(src)
-    waveform = waveform.numpy()
-    # to mono
-    if waveform.shape[0] > 1:
-        waveform = np.mean(waveform, axis=0, keepdims=True)
-    # resample
+) -> Iterable[str]:
+    # DirEntry caches the file type from readdir, so this avoids a stat() per path
+    stack = [str(root)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(exts) and entry.is_file():
+                    yield entry.path
+
+
+@njit(fastmath=True, cache=True)
+def mono_normalize(x: np.ndarray) -> np.ndarray:
+    # (frames, channels) -> peak-normalized mono PCM_16 (frames,): the peak is
+    # found in one pass and the second pass writes int16 directly, so
+    # sf.write has no float->int conversion left to do. Serial on purpose: it
+    # runs inside every pool worker, which already keep all cores busy
+    n, c = x.shape
+    peak = 0.0
+    for i in range(n):
+        s = 0.0
+        for ch in range(c):
+            s += x[i, ch]
+        peak = max(peak, abs(s / c))
+    scale = np.float32(32767.0 / c)
+    if peak >= 1e-8:
+        scale = np.float32(32767.0 / (peak * c))
+    out = np.empty(n, dtype=np.int16)
+    for i in range(n):
+        s = 0.0
+        for ch in range(c):
+            s += x[i, ch]
+        # np.rint rounds half to even
+        out[i] = np.int16(min(max(np.rint(s * scale), -32768.0), 32767.0))
+    return out
+
+
+_read_buffer = np.empty(0, dtype=np.float32)
+
+
+def _get_read_buffer(frames: int, channels: int) -> np.ndarray:
+    # one decode buffer per process, grown on demand and reused for every file
+    global _read_buffer
+    if _read_buffer.size < frames * channels:
+        _read_buffer = np.empty(frames * channels, dtype=np.float32)
+    return _read_buffer[: frames * channels].reshape(frames, channels)
+
+
+def read_audio(src: Path) -> tuple[np.ndarray, int]:
+    # returns float32 samples shaped (frames, channels); for files libsndfile
+    # can open the array is a view of the shared read buffer, so it is only
+    # valid until the next call
+    try:
+        with sf.SoundFile(str(src)) as f:
+            out = _get_read_buffer(f.frames, f.channels)
+            return f.read(dtype="float32", always_2d=True, out=out), f.samplerate
+    except sf.LibsndfileError:
+        # libsndfile cannot decode every container (e.g. m4a)
+        import torchaudio
+
+        waveform, sr = torchaudio.load(src)
+        return waveform.numpy().T, sr
+
+
+@functools.lru_cache(maxsize=32)
+def _get_resampler(src_sr: int, dst_sr: int) -> soxr.ResampleStream:
+    # filter design is the expensive part of soxr, so build it once per rate pair
+    # (per pool process) and clear() the stream between files
+    return soxr.ResampleStream(src_sr, dst_sr, 1, dtype="float32", quality="HQ")
+
+
+def resample(wave: np.ndarray, src_sr: int, dst_sr: int) -> np.ndarray:
+    resampler = _get_resampler(src_sr, dst_sr)
+    try:
+        return resampler.resample_chunk(wave, last=True)
+    finally:
+        resampler.clear()
+
+
+def preprocess_and_save(
+    src: Path, dst: Path, sample_rate: int, copy_matching: bool = False
+) -> tuple[float, int]:
+    if copy_matching and src.suffix.lower() == ".wav":
+        # already in the output format: copy it as-is (without peak
+        # normalization) and read the duration from the header
+        info = sf.info(str(src))
+        if (
+            info.samplerate == sample_rate
+            and info.channels == 1
+            and info.subtype == "PCM_16"
+        ):
+            shutil.copyfile(src, dst)
+            return info.frames / float(sample_rate), sample_rate
+
+    waveform, sr = read_audio(src)
+    # resample (downmixed first so soxr only filters one channel)
     if sr != sample_rate:
-        resampler = T.Resample(orig_freq=sr, new_freq=sample_rate)
-        waveform = resampler(torch_from_numpy(waveform)).numpy()
-    # normalize
-    waveform = normalize_audio(waveform)
-    # save
-    dst.parent.mkdir(parents=True, exist_ok=True)
-    sf.write(str(dst), waveform.squeeze(), sample_rate, subtype="PCM_16")
+        waveform = resample(waveform.mean(axis=1), sr, sample_rate)[:, None]
+    # to mono + normalize, quantized to int16
+    waveform = mono_normalize(waveform)
+    # save (dst.parent must already exist)
+    sf.write(str(dst), waveform, sample_rate, subtype="PCM_16")
     duration = waveform.shape[-1] / float(sample_rate)
     return duration, sample_rate
 
 
-def torch_from_numpy(arr: np.ndarray):
+def cuda_available() -> bool:
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
+
+
+@functools.lru_cache(maxsize=32)
+def _get_gpu_resampler(src_sr: int, dst_sr: int):
+    import torchaudio.transforms as T
+
+    return T.Resample(orig_freq=src_sr, new_freq=dst_sr).cuda()
+
+
+def resample_batch_and_save(
+    jobs: list[tuple[Path, Path, int, bool]], src_sr: int, sample_rate: int
+) -> list[tuple[Path, Path, float, str]]:
+    # every job in the batch must share src_sr; waves are zero-padded to the
+    # longest one and resampled in a single (B, L) call on the GPU
     import torch
 
-    return torch.from_numpy(arr)
+    waves = [read_audio(src)[0].mean(axis=1) for src, _, _, _ in jobs]
+    batch = np.zeros((len(waves), max(w.shape[0] for w in waves)), dtype=np.float32)
+    for i, wave in enumerate(waves):
+        batch[i, : wave.shape[0]] = wave
+    with torch.inference_mode():
+        resampled = (
+            _get_gpu_resampler(src_sr, sample_rate)(torch.from_numpy(batch).cuda())
+            .cpu()
+            .numpy()
+        )
+
+    results = []
+    for (src, dst, _, _), wave, out in zip(jobs, waves, resampled):
+        num_frames = math.ceil(wave.shape[0] * sample_rate / src_sr)
+        waveform = mono_normalize(out[:num_frames, None])
+        sf.write(str(dst), waveform, sample_rate, subtype="PCM_16")
+        duration = waveform.shape[-1] / float(sample_rate)
+        results.append((src, dst, duration, infer_label_from_path(src)))
+    return results
+
+
+def _worker(job: tuple[Path, Path, int, bool]) -> tuple[Path, Path, float, str]:
+    # Runs in a pool process, so it has to stay a picklable module-level function
+    src, dst, sample_rate, copy_matching = job
+    duration, _ = preprocess_and_save(src, dst, sample_rate, copy_matching)
+    return src, dst, duration, infer_label_from_path(src)
 
 
 # -----------------------
@@ -118,22 +242,19 @@ def make_caption_for_label(label: Optional[str]) -> str:
 # Manifest
 # -----------------------
 def build_manifest(rows: list[AudioMeta], out_manifest: Path):
-    df = pd.DataFrame(
-        [
-            {"wav_path": str(r.out_path), "caption": r.caption, "duration": r.duration}
-            for r in rows
-        ]
-    )
-    df.to_csv(out_manifest, index=False)
-    logger.info("Manifest saved to %s (%d rows)", out_manifest, len(df))
+    with open(out_manifest, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["wav_path", "caption", "duration"])
+        writer.writerows((r.out_path, r.caption, r.duration) for r in rows)
+    logger.info("Manifest saved to %s (%d rows)", out_manifest, len(rows))
 
 
 def build_json_base(rows: list[AudioMeta]) -> dict[str, list[dict[str, str]]]:
     def build_data_segment(
-        filepath: Path, caption: str, labels: str = ""
+        filepath: str, caption: str, labels: str = ""
     ) -> dict[str, str]:
         return {
-            "wav": str(filepath),
+            "wav": filepath,
             "seg_label": "/dummy/",
             "labels": labels,
             "caption": caption,
@@ -156,22 +277,22 @@ def build_manifest_as_json(
     train = []
     test = []
 
-    for label in dataset.keys():
-        samples = dataset[label].copy()
+    # shuffles the per-label lists in place; callers do not reuse dataset
+    for samples in dataset.values():
         random.shuffle(samples)
         num_tests = int(len(samples) * test_rate)
-        train.extend(samples[num_tests:])
         test.extend(samples[:num_tests])
+        train.extend(samples[num_tests:])
 
     train_manifest = build_json_base(train)
     test_manifest = build_json_base(test)
 
-    with open(train_manifest_path, "w") as f:
-        json.dump(train_manifest, f)
+    # orjson writes non-ASCII captions as raw UTF-8 rather than \u escapes,
+    # so the manifest readers in audioldm_train open these files as UTF-8
+    Path(train_manifest_path).write_bytes(orjson.dumps(train_manifest))
     logger.info("Manifest saved to %s (%d rows)", train_manifest_path, len(train))
 
-    with open(test_manifest_path, "w") as f:
-        json.dump(test_manifest, f)
+    Path(test_manifest_path).write_bytes(orjson.dumps(test_manifest))
     logger.info("Manifest saved to %s (%d rows)", test_manifest_path, len(test))
 
     dataset_meta = {}
@@ -186,8 +307,7 @@ def build_manifest_as_json(
             }
         }
     }
-    with open(dataset_meta_json_path, "w") as f:
-        json.dump(dataset_meta, f)
+    Path(dataset_meta_json_path).write_bytes(orjson.dumps(dataset_meta))
     logger.info("Dataset manifest saved to %s", dataset_meta_json_path)
 
 
@@ -199,6 +319,10 @@ def prepare(
     processed_dir: Path,
     sample_rate: int,
     manifest_path: Path,
+    num_workers: Optional[int] = None,
+    gpu_batch_size: int = 16,
+    copy_matching: bool = False,
+    gpu_resample: bool = False,
 ):
     audio_files = list(discover_audio_files(raw_dir))
     if not audio_files:
@@ -206,21 +330,69 @@ def prepare(
 
     logger.info("Found %d audio files for processing", len(audio_files))
 
-    dataset: dict[str, list[AudioMeta]] = {}
-    for src in tqdm(audio_files, desc="Processing audio"):
+    jobs: list[tuple[Path, Path, int, bool]] = []
+    out_dirs: set[Path] = set()
+    for path in audio_files:
+        src = Path(path)
         try:
             rel = src.relative_to(raw_dir)
         except Exception:
             rel = Path(src.name)
         out_path = processed_dir / rel.with_suffix(".wav")
-        duration, _ = preprocess_and_save(src, out_path, sample_rate)
-        label = infer_label_from_path(src)
-        caption = make_caption_for_label(label)
+        out_dirs.add(out_path.parent)
+        jobs.append((src, out_path, sample_rate, copy_matching))
+
+    # create every output directory up front instead of once per file
+    for out_dir in out_dirs:
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+    # opt-in: files that need resampling are bucketed by their original rate
+    # and resampled in batches on the GPU; the rest stay on the pool. Decode
+    # and encode for those files then run serially in this process, so this
+    # only pays off when resampling dominates
+    cpu_jobs = jobs
+    gpu_buckets: dict[int, list[tuple[Path, Path, int, bool]]] = {}
+    if gpu_resample and cuda_available():
+        cpu_jobs = []
+        for job in jobs:
+            try:
+                sr = sf.info(str(job[0])).samplerate
+            except sf.LibsndfileError:
+                sr = sample_rate
+            if sr == sample_rate:
+                cpu_jobs.append(job)
+            else:
+                gpu_buckets.setdefault(sr, []).append(job)
+        logger.info(
+            "Resampling %d files on GPU", sum(len(b) for b in gpu_buckets.values())
+        )
 
+    results: list[tuple[Path, Path, float, str]] = []
+    with ProcessPoolExecutor(max_workers=num_workers or os.cpu_count()) as ex:
+        # map keeps the input order, so the seeded train/test split stays reproducible
+        cpu_results = ex.map(_worker, cpu_jobs, chunksize=16)
+        with tqdm(total=len(jobs), desc="Processing audio") as pbar:
+            for src_sr, bucket in gpu_buckets.items():
+                for i in range(0, len(bucket), gpu_batch_size):
+                    batch = bucket[i : i + gpu_batch_size]
+                    results.extend(resample_batch_and_save(batch, src_sr, sample_rate))
+                    pbar.update(len(batch))
+            for result in cpu_results:
+                results.append(result)
+                pbar.update()
+
+    # labels repeat heavily, so each caption is built once and shared
+    dataset: dict[str, list[AudioMeta]] = {}
+    captions: dict[str, str] = {}
+    for src, out_path, duration, label in results:
         if label not in dataset.keys():
             dataset[label] = []
+            captions[label] = make_caption_for_label(label)
 
-        dataset[label].append(AudioMeta(src, out_path, duration, label, caption))
+        # stored as str once so the manifest writers don't convert per row
+        dataset[label].append(
+            AudioMeta(src, str(out_path), duration, label, captions[label])
+        )
 
     # build_manifest(dataset, manifest_path)
     build_manifest_as_json(dataset, manifest_path)
@@ -255,6 +427,30 @@ def parse_args():
         default="./data/dataset/kaggle_dataset",
         help="Output manifest JSON files",
     )
+    p.add_argument(
+        "--num-workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of CPUs)",
+    )
+    p.add_argument(
+        "--gpu-resample",
+        action="store_true",
+        help="Resample on the GPU with torchaudio when CUDA is available "
+        "(instead of soxr HQ in the worker processes)",
+    )
+    p.add_argument(
+        "--gpu-batch-size",
+        type=int,
+        default=16,
+        help="Files resampled together per GPU batch with --gpu-resample",
+    )
+    p.add_argument(
+        "--copy-matching",
+        action="store_true",
+        help="Copy mono 16-bit wav files already at the target sample rate "
+        "instead of re-encoding them (skips peak normalization)",
+    )
     return p.parse_args()
 
 
@@ -266,6 +462,10 @@ def main():
             processed_dir=Path(args.out_dir),
             sample_rate=args.sample_rate,
             manifest_path=Path(args.manifest_dir),
+            num_workers=args.num_workers,
+            gpu_batch_size=args.gpu_batch_size,
+            copy_matching=args.copy_matching,
+            gpu_resample=args.gpu_resample,
         )
     except Exception as e:
         logger.exception("Failed: %s", e)
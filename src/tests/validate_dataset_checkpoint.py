@@ -21,7 +21,7 @@ expected_structure = {
 
 
 def load_json(fname):
-    with open(fname, "r") as f:
+    with open(fname, "r", encoding="utf-8") as f:
         data = json.load(f)
         return data
 